@@ -1,25 +1,121 @@
 import pandas as pd
-import re
+import numpy as np
 import logging
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
+import queue
+import atexit
+import hashlib
 import customtkinter as ctk
 from tkinter import filedialog, messagebox
 from tkinter import ttk
 from twilio.rest import Client
-import time
+from twilio.base import values
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+import asyncio
+import threading
 import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 
 # Set up logging
-logging.basicConfig(filename='opt_in.log', level=logging.INFO, 
-                    format='%(asctime)s:%(levelname)s:%(message)s')
+log_file_handler = logging.FileHandler('opt_in.log', delay=True)
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(message)s'))
+
+# Buffer records and write them out every 500 records (errors are written immediately)
+log_buffer_handler = MemoryHandler(500, flushLevel=logging.ERROR, target=log_file_handler)
+
+# Function to write buffered log records to disk at least once a second, on its own thread
+def flush_log_buffer(stop_event):
+    while not stop_event.wait(1):
+        log_buffer_handler.flush()
+
+log_flush_stop = threading.Event()
+threading.Thread(target=flush_log_buffer, args=(log_flush_stop,), daemon=True).start()
+atexit.register(log_flush_stop.set)
+
+# Callers only put records on a queue; a listener thread does the file I/O
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, log_buffer_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+log_queue_handler = QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[log_queue_handler])
 
 # Global variable to hold customer data
 customer_data = None
-opted_out_numbers = set()
+opted_out_numbers = frozenset()
+
+# Row counts completed by the dispatch thread, applied to the progress bar by the Tk thread
+progress_updates = queue.SimpleQueue()
+
+# (start time, succeeded) for each finished dispatch run, reported by the Tk thread
+finished_runs = queue.SimpleQueue()
+
+# Number of message bodies rendered at a time; rendered bodies are the largest per-recipient
+# data, so only one slice of them is held while the send queue drains
+BATCH_SIZE = 1000
+
+# Status checks back off exponentially between these bounds, in seconds
+STATUS_CHECK_INITIAL_DELAY = 0.2
+STATUS_CHECK_MAX_DELAY = 2
+
+# (Account SID, auth token hash) pairs that Twilio has already accepted this session
+validated_credentials = set()
+
+# Shared keep-alive HTTP session for the synchronous Twilio requests made from the GUI
+twilio_http_client = TwilioHttpClient()
+
+# Number of Twilio requests in flight at once (matches the aiohttp connection pool)
+MAX_CONCURRENT_REQUESTS = 100
+
+# Share of those requests reserved for status checks; the rest go to send workers
+MAX_CONCURRENT_STATUS_CHECKS = 10
+
+# Sends wait once this many status checks are outstanding, so they can't pile up without bound
+MAX_PENDING_STATUS_CHECKS = 10000
+
+# Sends rejected with 429 Too Many Requests are retried with exponential backoff, in seconds.
+# Twilio doesn't create a message for a 429, so a retry can't send it twice
+SEND_RETRY_ATTEMPTS = 6
+SEND_RETRY_INITIAL_DELAY = 1
+
+# Phone numbers must be in E.164 format, e.g. +15551234567 (at most 16 characters, with some headroom)
+MAX_PHONE_LENGTH = 20
+
+# Function to check a whole column of phone numbers for a '+' followed only by ASCII digits
+def valid_phone_mask(phone_numbers):
+    lengths = phone_numbers.str.len().to_numpy(dtype=np.int64)
+    
+    # Lay the numbers out as a fixed-width grid of code points, zero-padded on the right
+    chars = phone_numbers.to_numpy(dtype=f'<U{MAX_PHONE_LENGTH}')
+    codes = chars.view(np.uint32).reshape(-1, MAX_PHONE_LENGTH)
+    
+    # Unsigned wrap-around turns the '0'..'9' range check into a single comparison
+    digit_counts = ((codes[:, 1:] - ord('0')) <= 9).sum(axis=1)
+    
+    valid = (
+        (codes[:, 0] == ord('+'))
+        & (lengths >= 2)
+        & (lengths <= MAX_PHONE_LENGTH)
+        & (digit_counts == lengths - 1)
+    )
+    return pd.Series(valid, index=phone_numbers.index)
 
-# Function to validate phone numbers
-def is_valid_phone_number(phone):
-    return re.match(r'^\+\d+$', phone) is not None
+# Function to read only the columns we need from the spreadsheet
+def read_customer_sheet(file_path):
+    read_options = {
+        "usecols": lambda column: column in ('Name', 'Phone Number'),
+        "dtype": {'Name': 'string', 'Phone Number': 'string'},
+    }
+    try:
+        # calamine is a much faster reader for both .xlsx and .xls files
+        return pd.read_excel(file_path, engine='calamine', **read_options)
+    except (ImportError, ValueError):
+        # Fall back to the default engine for the file type
+        return pd.read_excel(file_path, **read_options)
 
 # Function to load customer data
 def load_customer_data():
@@ -33,12 +129,22 @@ def load_customer_data():
         if not file_path:
             return None
         
-        customer_data = pd.read_excel(file_path)
+        customer_data = read_customer_sheet(file_path)
         
         # Check for required columns
         if 'Name' not in customer_data.columns or 'Phone Number' not in customer_data.columns:
             raise ValueError("The spreadsheet must contain 'Name' and 'Phone Number' columns.")
         
+        # Normalize phone numbers once so numeric cells and stray spaces don't need handling later
+        customer_data['Phone Number'] = customer_data['Phone Number'].astype('string').str.strip().fillna('')
+        
+        # Send only one message per phone number, keeping the first row for each
+        row_count = len(customer_data)
+        customer_data = customer_data.drop_duplicates(subset='Phone Number', keep='first').reset_index(drop=True)
+        duplicate_count = row_count - len(customer_data)
+        if duplicate_count:
+            logging.info(f"Removed {duplicate_count} duplicate phone numbers")
+        
         messagebox.showinfo("Success", "Customer data loaded successfully!")
         load_button.configure(text="Data Loaded", fg_color="green")  # Visual confirmation
         return customer_data
@@ -48,33 +154,110 @@ def load_customer_data():
         load_button.configure(text="Load Failed", fg_color="red")  # Visual indication of failure
         return None
 
+# Function to turn the message template into a function that renders a column of names
+def compile_message_template(message_template):
+    # Split on the placeholder once, when sending starts, rather than for every slice of names
+    parts = message_template.split("{Name}")
+    if len(parts) == 1:
+        return lambda names: [message_template] * len(names)
+    
+    def render_message_bodies(names):
+        names = names.fillna("").astype(str)  # A missing name renders as blank
+        bodies = names.radd(parts[0])
+        for part in parts[1:-1]:
+            bodies = bodies.add(part).add(names)
+        return bodies.add(parts[-1]).to_numpy()
+    
+    return render_message_bodies
+
+# Function to drop rows with invalid or opted-out phone numbers, logging each skipped number
+def select_recipients(data):
+    # Validate every phone number in a single vectorized pass
+    phone_numbers = data['Phone Number']
+    valid = valid_phone_mask(phone_numbers)
+    
+    for customer_phone in phone_numbers[~valid]:
+        logging.warning(f"Invalid phone number skipped: {customer_phone}")
+    
+    mask = valid
+    # Skip building a hash table when nobody has opted out
+    if opted_out_numbers:
+        opted_out = valid & phone_numbers.isin(opted_out_numbers)
+        for customer_phone in phone_numbers[opted_out]:
+            logging.info(f"Skipping opted-out number: {customer_phone}")
+        mask = valid & ~opted_out
+    
+    return data[mask]
+
+# Function to yield (name, phone number, message body) for each recipient
+def iter_messages(recipients, render_message_bodies, batch_size=BATCH_SIZE):
+    # Render bodies one slice at a time, as the send queue drains, rather than all up front
+    for start in range(0, len(recipients), batch_size):
+        batch = recipients.iloc[start:start + batch_size]
+        bodies = render_message_bodies(batch['Name'])
+        yield from zip(batch['Name'].to_numpy(), batch['Phone Number'].to_numpy(), bodies)
+
 # Function to send a single SMS message and return the message SID
-def send_single_sms(client, twilio_phone_number, customer_name, customer_phone, message_body):
-    try:
-        message = client.messages.create(
-            body=message_body,
-            from_=twilio_phone_number,
-            to=customer_phone
-        )
-        logging.info(f"Message sent to {customer_name} at {customer_phone} with SID: {message.sid}")
-        return message.sid  # Return the message SID for status checking later
-    except Exception as e:
-        logging.error(f"Failed to send message to {customer_name} at {customer_phone}: {str(e)}")
-        return None
+async def send_single_sms(client, twilio_phone_number, customer_name, customer_phone, message_body, status_callback=None):
+    delay = SEND_RETRY_INITIAL_DELAY
+    for attempt in range(SEND_RETRY_ATTEMPTS):
+        try:
+            message = await client.messages.create_async(
+                body=message_body,
+                from_=twilio_phone_number,
+                to=customer_phone,
+                # Twilio posts delivery updates to the callback URL, if one is set
+                status_callback=status_callback or values.unset
+            )
+            logging.info(f"Message sent to {customer_name} at {customer_phone} with SID: {message.sid}")
+            return message.sid  # Return the message SID for status checking later
+        except TwilioRestException as e:
+            if e.status != 429 or attempt == SEND_RETRY_ATTEMPTS - 1:
+                logging.error(f"Failed to send message to {customer_name} at {customer_phone}: {str(e)}")
+                return None
+            logging.warning(f"Rate limited sending to {customer_name} at {customer_phone}, retrying in {delay}s")
+            await asyncio.sleep(delay)
+            delay *= 2
+        except Exception as e:
+            logging.error(f"Failed to send message to {customer_name} at {customer_phone}: {str(e)}")
+            return None
+
+# Function to keep sending queued messages until it receives the None sentinel
+async def sms_worker(client, send_queue, twilio_phone_number, status_callback, start_status_check):
+    while True:
+        item = await send_queue.get()
+        if item is None:
+            return
+        
+        customer_name, customer_phone, message_body = item
+        message_sid = await send_single_sms(client, twilio_phone_number, customer_name, customer_phone, message_body, status_callback)
+        # Start polling for delivery right away so it overlaps with the remaining sends,
+        # unless the statuses are pushed to the callback URL instead
+        if message_sid and not status_callback:
+            await start_status_check(message_sid, customer_name, customer_phone)
+        progress_updates.put(1)
 
 # Function to check the status of a message after it has been sent
-def check_message_status(client, message_sid, customer_name, customer_phone):
+async def check_message_status(client, fetch_slots, message_sid, customer_name, customer_phone):
     try:
-        # Loop to check message status until it is delivered or fails
+        delay = STATUS_CHECK_INITIAL_DELAY
+        # Loop to check message status until it reaches a final state
         for _ in range(10):  # Limit the number of checks to avoid infinite loops
-            msg_status = client.messages(message_sid).fetch().status
+            # Only hold a connection slot for the fetch itself, not while waiting between checks
+            async with fetch_slots:
+                msg_status = (await client.messages(message_sid).fetch_async()).status
             if msg_status == "delivered":
                 logging.info(f"Message delivered to {customer_name} at {customer_phone}")
                 return True
+            elif msg_status == "sent":
+                # Carriers without delivery receipts never move past "sent"
+                logging.info(f"Message sent to carrier for {customer_name} at {customer_phone}")
+                return True
             elif msg_status in ["failed", "undelivered"]:
                 logging.error(f"Message failed to {customer_name} at {customer_phone}")
                 return False
-            time.sleep(2)  # Wait before checking again
+            await asyncio.sleep(delay)  # Wait before checking again
+            delay = min(delay * 2, STATUS_CHECK_MAX_DELAY)
         
         # If the status is still unknown after all checks
         logging.warning(f"Message delivery status for {customer_name} at {customer_phone} is unknown")
@@ -84,6 +267,93 @@ def check_message_status(client, message_sid, customer_name, customer_phone):
         logging.error(f"Failed to check status for message to {customer_name} at {customer_phone}: {str(e)}")
         return False
 
+# Function to send every message over a single shared async HTTP session
+async def dispatch_sms(recipients, account_sid, auth_token, twilio_phone_number, render_message_bodies, status_callback):
+    async with AsyncTwilioHttpClient() as http_client:
+        client = Client(account_sid, auth_token, http_client=http_client)
+        status_checks = set()  # Status check tasks that are still running
+        fetch_slots = asyncio.Semaphore(MAX_CONCURRENT_STATUS_CHECKS)
+        pending_slots = asyncio.Semaphore(MAX_PENDING_STATUS_CHECKS)
+        
+        # Print each check's outcome as soon as it finishes and let go of the finished task
+        def status_check_done(task):
+            status_checks.discard(task)
+            pending_slots.release()
+            if task.cancelled():
+                return
+            if task.result():
+                print("Message sent")
+            else:
+                print("Message haven't sent")
+        
+        async def start_status_check(message_sid, customer_name, customer_phone):
+            await pending_slots.acquire()  # Wait for a free slot if too many checks are outstanding
+            task = asyncio.create_task(check_message_status(client, fetch_slots, message_sid, customer_name, customer_phone))
+            status_checks.add(task)
+            task.add_done_callback(status_check_done)
+        
+        # A bounded queue keeps only a few messages per worker waiting at any time
+        send_queue = asyncio.Queue(maxsize=MAX_CONCURRENT_REQUESTS * 4)
+        workers = [
+            asyncio.create_task(sms_worker(client, send_queue, twilio_phone_number, status_callback, start_status_check))
+            for _ in range(MAX_CONCURRENT_REQUESTS - MAX_CONCURRENT_STATUS_CHECKS)
+        ]
+        
+        for item in iter_messages(recipients, render_message_bodies):
+            await send_queue.put(item)
+        
+        # One sentinel per worker, then wait for the queue to drain
+        for _ in workers:
+            await send_queue.put(None)
+        await asyncio.gather(*workers)
+        
+        # Wait for the status checks that are still running
+        if status_checks:
+            await asyncio.wait(set(status_checks))
+
+# Function to run the SMS dispatch on a background thread so the GUI stays responsive
+def run_sms_dispatch(recipients, account_sid, auth_token, twilio_phone_number, render_message_bodies, status_callback, start_time):
+    try:
+        asyncio.run(dispatch_sms(recipients, account_sid, auth_token, twilio_phone_number, render_message_bodies, status_callback))
+        succeeded = True
+    except Exception as e:
+        logging.error(f"Failed to send SMS messages: {str(e)}")
+        succeeded = False
+    finished_runs.put((start_time, succeeded))
+
+# Function to report the end of an SMS run, called on the Tk thread
+def finish_sms_sending(start_time, succeeded):
+    end_time = datetime.datetime.now()
+    logging.info(f"SMS sending finished at {end_time}. Duration: {end_time - start_time}")
+    
+    if succeeded:
+        messagebox.showinfo("Success", "SMS messages processed!")
+        send_button.configure(text="Messages Processed", fg_color="green", state="normal")
+    else:
+        messagebox.showerror("Error", "Failed to send SMS messages. See the log for details.")
+        send_button.configure(text="Sending Failed", fg_color="red", state="normal")
+
+# Function to apply the queued progress updates and run results on the Tk thread 20 times a second
+def pump_progress_updates():
+    completed = 0
+    try:
+        while True:
+            completed += progress_updates.get_nowait()
+    except queue.Empty:
+        pass
+    
+    if completed:
+        progress["value"] += completed
+        progress.update_idletasks()
+    
+    # Progress is applied first, so the bar is full before the result is shown
+    try:
+        while True:
+            finish_sms_sending(*finished_runs.get_nowait())
+    except queue.Empty:
+        pass
+    root.after(50, pump_progress_updates)
+
 # Function to send SMS messages
 def send_sms():
     global customer_data, opted_out_numbers
@@ -94,6 +364,7 @@ def send_sms():
     account_sid = sid_entry.get()
     auth_token = token_entry.get()
     twilio_phone_number = phone_entry.get()
+    status_callback = callback_entry.get().strip()
     
     if not account_sid or not auth_token or not twilio_phone_number:
         messagebox.showerror("Error", "Please enter all Twilio credentials.")
@@ -104,9 +375,19 @@ def send_sms():
         messagebox.showerror("Error", "Please enter the message text.")
         return
     
+    if status_callback:
+        callback_url = urlparse(status_callback)
+        if callback_url.scheme not in ("http", "https") or not callback_url.netloc:
+            messagebox.showerror("Error", "The status callback URL must start with http:// or https://.")
+            return
+    
+    # Only check the credentials with Twilio the first time they are used this session
+    credentials_key = (account_sid, hashlib.sha256(auth_token.encode()).hexdigest())
     try:
-        client = Client(account_sid, auth_token)
-        client.api.accounts(sid=account_sid).fetch()
+        if credentials_key not in validated_credentials:
+            client = Client(account_sid, auth_token, http_client=twilio_http_client)
+            client.api.accounts(sid=account_sid).fetch()
+            validated_credentials.add(credentials_key)
     except Exception as e:
         error_message = (
             "Failed to authenticate Twilio credentials.\n"
@@ -120,62 +401,32 @@ def send_sms():
     start_time = datetime.datetime.now()
     logging.info(f"SMS sending started at {start_time}")
     
-    progress["maximum"] = len(customer_data)
-    progress["value"] = 0  # Reset progress bar
-    
-    message_sids = []  # Store message SIDs for later status checking
-    
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = []
-        for index, row in customer_data.iterrows():
-            customer_name = row['Name']
-            customer_phone = str(row['Phone Number'])
-            
-            if not is_valid_phone_number(customer_phone):
-                logging.warning(f"Invalid phone number skipped: {customer_phone}")
-                continue
-            
-            if customer_phone in opted_out_numbers:
-                logging.info(f"Skipping opted-out number: {customer_phone}")
-                continue
-            
-            message_body = message_template.replace("{Name}", customer_name)
-            
-            futures.append(executor.submit(send_single_sms, client, twilio_phone_number, customer_name, customer_phone, message_body))
-        
-        for future in as_completed(futures):
-            message_sid = future.result()
-            if message_sid:
-                message_sids.append((message_sid, row['Name'], row['Phone Number']))
-            progress["value"] += 1
-            root.update_idletasks()
-    
-    # Check the statuses after all messages have been sent
-    for message_sid, customer_name, customer_phone in message_sids:
-        status = check_message_status(client, message_sid, customer_name, customer_phone)
-        if status:
-            print("Message sent")
-        else:
-            print("Message haven't sent")
+    recipients = select_recipients(customer_data)
     
-    end_time = datetime.datetime.now()
-    logging.info(f"SMS sending finished at {end_time}. Duration: {end_time - start_time}")
+    progress["maximum"] = len(recipients)
+    progress["value"] = 0  # Reset progress bar
+    send_button.configure(text="Sending...", fg_color="orange", state="disabled")
     
-    messagebox.showinfo("Success", "SMS messages processed!")
-    send_button.configure(text="Messages Processed", fg_color="green")
+    threading.Thread(
+        target=run_sms_dispatch,
+        args=(recipients, account_sid, auth_token, twilio_phone_number, compile_message_template(message_template), status_callback, start_time),
+        daemon=True
+    ).start()
 
 # Set up the GUI
 ctk.set_appearance_mode("light")
 ctk.set_default_color_theme("blue")
 
 root = ctk.CTk()
-root.geometry("500x600")
+root.geometry("500x680")
 root.title("SMS Sender")
 
 # Ensure the window pops up on the current tab and in the foreground
 root.attributes('-topmost', True)
 root.after(100, lambda: root.attributes('-topmost', False))
 
+root.after(50, pump_progress_updates)
+
 label = ctk.CTkLabel(root, text="Automated SMS Sender", font=ctk.CTkFont(size=24, weight="bold"))
 label.pack(pady=20)
 
@@ -194,6 +445,11 @@ phone_label.pack(pady=10)
 phone_entry = ctk.CTkEntry(root, width=400)
 phone_entry.pack(pady=5)
 
+callback_label = ctk.CTkLabel(root, text="Status Callback URL (optional):", font=ctk.CTkFont(size=16))
+callback_label.pack(pady=10)
+callback_entry = ctk.CTkEntry(root, width=400, placeholder_text="https://your-host/twilio-status")
+callback_entry.pack(pady=5)
+
 message_label = ctk.CTkLabel(root, text="Enter Message Text (use {Name} for customer name):", font=ctk.CTkFont(size=16))
 message_label.pack(pady=10)
 